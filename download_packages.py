@@ -1,14 +1,49 @@
 import json
+import logging
 import os
+import re
 import requests
 import hashlib
 import base64
+import mmap
 import configparser
 import concurrent.futures
+from requests.adapters import HTTPAdapter
 from tqdm import tqdm
 from urllib.parse import urlparse, urljoin
+from urllib3.util.retry import Retry
 from pathlib import Path
 
+from log_setup import setup_queue_logging
+
+try:
+    # Rust 实现的 JSON 解析/序列化，大 lockfile 下比标准库快数倍；可选依赖
+    import orjson
+except ImportError:
+    orjson = None
+
+# 模块级共享 Session：通过 keep-alive 复用 TCP/TLS 连接，
+# 避免每个包都重新握手。urllib3 的连接池是线程安全的，
+# 池大小需 >= max_workers，否则多余的线程会各自新建连接。
+SESSION = requests.Session()
+_adapter = HTTPAdapter(
+    pool_connections=32,
+    pool_maxsize=32,
+    max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[502, 503, 504]),
+)
+SESSION.mount('https://', _adapter)
+SESSION.mount('http://', _adapter)
+
+# 流式读写/哈希的缓冲区大小。64 KiB 通常不小于文件系统簇大小，
+# 相比 8 KiB 能把 Python 层的循环次数和 hashlib.update 调用减少约 8 倍。
+READ_BUF = 1 << 16
+
+# 从 integrity 字符串中提取 sha512 的 base64 值，
+# 预编译后单次扫描即可，无需按空格拆分再逐段判断前缀
+_SHA512_RE = re.compile(r'sha512-([A-Za-z0-9+/=]+)')
+
+logger = logging.getLogger(__name__)
+
 
 def load_config():
     """加载 config.ini 配置"""
@@ -26,12 +61,14 @@ def parse_package_lock(lockfile_path):
     print(f"正在解析 {lockfile_path}...")
     packages_to_download = []
     try:
-        with open(lockfile_path, 'r', encoding='utf-8') as f:
-            data = json.load(f)
+        with open(lockfile_path, 'rb') as f:
+            raw = f.read()
+        data = orjson.loads(raw) if orjson is not None else json.loads(raw)
     except FileNotFoundError:
         print(f"错误: {lockfile_path} 未找到。")
         return []
-    except json.JSONDecodeError:
+    except ValueError:
+        # orjson.JSONDecodeError / json.JSONDecodeError 都是 ValueError 子类
         print(f"错误: {lockfile_path} 文件格式不正确。")
         return []
 
@@ -40,6 +77,9 @@ def parse_package_lock(lockfile_path):
         print("警告: 'packages' 字段为空或未找到。这可能是一个 v1 格式的 lockfile，此脚本仅支持 v2/v3。")
         return []
 
+    # 热循环中把方法查找绑定为局部变量，省去每次迭代的属性查找
+    append = packages_to_download.append
+    search = _SHA512_RE.search
     for path, details in all_packages.items():
         # 跳过根项目 (path == "")
         if not path:
@@ -51,125 +91,229 @@ def parse_package_lock(lockfile_path):
 
         # 从 'path' 中推断 'name'
         # e.g., "node_modules/@angular/core" -> "@angular/core"
-        name = path[path.rfind('node_modules/') + len('node_modules/'):]
+        name = path.rpartition('node_modules/')[2] or path
 
         if not all([resolved, integrity, version, name]):
             print(f"跳过无效条目: {path}")
             continue
 
         # 提取 sha512
-        sha512_b64 = None
-        for s in integrity.split(' '):
-            if s.startswith('sha512-'):
-                sha512_b64 = s.replace('sha512-', '')
-                break
+        m = search(integrity)
+        sha512_b64 = m.group(1) if m else None
 
         if not sha512_b64:
             print(f"警告: 未找到 {name}@{version} 的 sha512 值，跳过。")
             continue
 
-        packages_to_download.append({
+        # 解析时一次性把 base64 摘要转成 hex，下载热路径只需比较原始字节，
+        # 不必每个包再做 base64 编解码往返
+        try:
+            sha512_hex = base64.b64decode(sha512_b64).hex()
+        except ValueError:
+            print(f"警告: {name}@{version} 的 sha512 值无法解码，跳过。")
+            continue
+
+        append({
             'name': name,
             'version': version,
             'resolved': resolved,
-            'sha512_b64': sha512_b64
+            'sha512_hex': sha512_hex
         })
 
     print(f"解析完成，共找到 {len(packages_to_download)} 个依赖包。")
     return packages_to_download
 
 
-def download_package(package_details, config):
-    """
-    下载单个包，验证 checksum，并返回元数据。
+def _hash_cached_file(path):
+    """对磁盘上已有的文件做 SHA-512。
+
+    通过 mmap 把整个文件映射进来后一次性喂给 OpenSSL，
+    既免掉了用户态的读缓冲拷贝，也只有一次 Python->C 调用，
+    让哈希吞吐接近 OpenSSL 的裸速。空文件无法 mmap，退回 file_digest。
     """
-    name = package_details['name']
-    version = package_details['version']
-    original_url = package_details['resolved']
-    expected_sha512_b64 = package_details['sha512_b64']
+    with open(path, 'rb') as f:
+        try:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                return hashlib.sha512(mm)
+        except (ValueError, OSError):
+            return hashlib.file_digest(f, 'sha512')
 
-    downloader_cfg = config['Downloader']
-    download_dir = downloader_cfg.get('download_dir', 'npm_tgz')
+
+def _tgz_filename(name, version):
+    """包名/版本 -> 规范化的本地 .tgz 文件名（作用域分隔符替换为 #）"""
+    pkg_filename_base = name.replace('/', '#').replace('\\', '#')
+    return f"{pkg_filename_base}-{version}.tgz"
+
+
+def _make_url_fn(downloader_cfg):
+    """把 URL 策略的配置判断一次性求值，返回 包 -> 下载URL 的函数。
+
+    每个包调用时不再重复读配置、重走 if 分支。
+    """
     use_resolved = downloader_cfg.getboolean('use_resolved_url', True)
     mirror = downloader_cfg.get('mirror_registry')
+    if use_resolved or not mirror:
+        return lambda pkg: pkg['resolved']
 
-    # 确定下载URL
-    download_url = original_url
-    if not use_resolved and mirror:
+    def mirror_url(pkg):
         # 强制使用镜像源，需要根据 'name' 和 'version' 重建 URL
         # e.g., @angular/core -> @angular/core/-/core-15.0.0.tgz
         # e.g., react -> react/-/react-18.0.0.tgz
+        name = pkg['name']
         pkg_filename_base = name.split('/')[-1]
-        pkg_filename = f"{pkg_filename_base}-{version}.tgz"
         # 使用 urljoin 来正确处理 /
-        download_url = urljoin(mirror, f"{name}/-/{pkg_filename}")
+        return urljoin(mirror, f"{name}/-/{pkg_filename_base}-{pkg['version']}.tgz")
+
+    return mirror_url
+
+
+def _build_meta_entry(name, version, download_url, tgz_path, sha512_hex):
+    """组装上传阶段所需的元数据条目"""
+    # e.g., name: @angular/core -> group: @angular, name: core
+    group = ''
+    pkg_name = name
+    if '/' in name:
+        group, pkg_name = name.split('/', 1)
+
+    # Nexus 搜索时通常使用 "name-version" 格式, e.g., "react-18.2.0"
+    nexus_search_name = f"{pkg_name}-{version}"
+
+    return {
+        'group': group,
+        'name': pkg_name,
+        'version': version,
+        'nexus_search_name': nexus_search_name,
+        'download_url': download_url,
+        'local_path': tgz_path,  # download_dir 已在 main 中转为绝对路径
+        'sha512_hex': sha512_hex  # 存储 hex 用于 Nexus API 比较
+    }
+
+
+def _stream_to_file(response, tgz_path, mode, hasher):
+    """把响应体流式写入文件，同步更新哈希（只过一遍数据）
+
+    write/update 绑定为局部变量后，循环体内只剩两次 C 调用；
+    两者处理 64 KiB 块时都会释放 GIL，线程池里的下载得以真正并行。
+    """
+    with open(tgz_path, mode) as f:
+        write = f.write
+        update = hasher.update
+        for chunk in response.iter_content(chunk_size=READ_BUF):
+            write(chunk)
+            update(chunk)
+
+
+def _remote_size(download_url):
+    """HEAD 获取远端文件大小；不可用时返回 -1"""
+    try:
+        head = SESSION.head(download_url, timeout=15, allow_redirects=True)
+        head.raise_for_status()
+        return int(head.headers.get('Content-Length', -1))
+    except (requests.RequestException, ValueError):
+        return -1
+
+
+def _read_sidecar(tgz_path):
+    """读取 .tgz 对应的 .sha512 sidecar；大小与记录一致时返回 hex 摘要，否则返回 None。"""
+    sidecar = tgz_path + '.sha512'
+    if not (os.path.exists(tgz_path) and os.path.exists(sidecar)):
+        return None
+    try:
+        with open(sidecar, 'r', encoding='utf-8') as f:
+            hex_digest, recorded_size = f.read().split('\n')[:2]
+        if int(recorded_size) != os.path.getsize(tgz_path):
+            return None
+        return hex_digest
+    except (ValueError, OSError):
+        return None
+
+
+def _write_sidecar(tgz_path, hex_digest):
+    """写入 .sha512 sidecar（摘要 + 文件大小），供下次运行跳过重新哈希。"""
+    try:
+        with open(tgz_path + '.sha512', 'w', encoding='utf-8') as f:
+            f.write(f"{hex_digest}\n{os.path.getsize(tgz_path)}")
+    except OSError:
+        # sidecar 只是加速缓存，写失败不影响正确性
+        pass
+
+
+def download_package(package_details, url_fn, download_dir):
+    """
+    下载单个包，验证 checksum，并返回元数据。
+
+    URL 策略和下载目录由 main_download 预先求值一次传入，
+    每个包不再重复读取配置。
+    """
+    name = package_details['name']
+    version = package_details['version']
+    expected_sha512_hex = package_details['sha512_hex']
+
+    # 确定下载URL
+    download_url = url_fn(package_details)
 
     # 确定本地文件名和路径
     # 我们使用规范化的名称（非作用域部分 + 版本）作为文件名
-    pkg_filename_base = name.replace('/', '#').replace('\\', '#')
-    pkg_filename = f"{pkg_filename_base}-{version}.tgz"
-    tgz_path = os.path.join(download_dir, pkg_filename)
-
-    # 确保目录存在
-    Path(download_dir).mkdir(exist_ok=True)
+    tgz_path = os.path.join(download_dir, _tgz_filename(name, version))
 
     try:
-        downloaded_hash = hashlib.sha512()
-        if os.path.exists(tgz_path):
-            with open(tgz_path, 'rb') as f:
-                # 循环读取文件块
-                while True:
-                    chunk = f.read(8192)
-                    if not chunk:
-                        # 读取完毕，跳出循环
-                        break
-                    # 更新哈希值
-                    downloaded_hash.update(chunk)
-        else:
-            # 下载
-            r = requests.get(download_url, stream=True, timeout=60)
-            r.raise_for_status()
-            with open(tgz_path, 'wb') as f:
-                for chunk in r.iter_content(chunk_size=8192):
-                    f.write(chunk)
-                    downloaded_hash.update(chunk)
-
-        # 验证
-        downloaded_hash_b64 = base64.b64encode(downloaded_hash.digest()).decode('utf-8')
-        downloaded_hash_hex = downloaded_hash.hexdigest()
-
-        if downloaded_hash_b64 != expected_sha512_b64:
-            os.remove(tgz_path)  # 删除坏文件
-            raise ValueError(f"SHA-512 校验失败! 预期: {expected_sha512_b64}, 得到: {downloaded_hash_b64}")
+        # 快速路径：sidecar 记录的摘要与预期一致时，免去整个文件的重新哈希；
+        # 不一致（或无 sidecar）则走完整哈希路径重新校验
+        downloaded_hash_hex = None
+        if _read_sidecar(tgz_path) == expected_sha512_hex:
+            downloaded_hash_hex = expected_sha512_hex
+
+        if downloaded_hash_hex is None:
+            if os.path.exists(tgz_path):
+                # 本地已有文件，可能是完整缓存，也可能是上次中断留下的部分文件
+                local_size = os.path.getsize(tgz_path)
+                expected_size = _remote_size(download_url)
+                if 0 <= local_size < expected_size:
+                    # 部分文件：先把已有前缀哈希进来，再用 Range 续传剩余字节
+                    downloaded_hash = _hash_cached_file(tgz_path)
+                    r = SESSION.get(download_url,
+                                    headers={'Range': f'bytes={local_size}-'},
+                                    stream=True, timeout=60)
+                    r.raise_for_status()
+                    if r.status_code == 206:
+                        _stream_to_file(r, tgz_path, 'ab', downloaded_hash)
+                    else:
+                        # 服务器不支持 Range，返回了完整内容，整文件重写
+                        downloaded_hash = hashlib.sha512()
+                        _stream_to_file(r, tgz_path, 'wb', downloaded_hash)
+                else:
+                    # 大小一致（npm 的 tgz 按版本不可变）或 HEAD 不可用：
+                    # 直接整文件哈希走校验
+                    downloaded_hash = _hash_cached_file(tgz_path)
+            else:
+                # 下载（边写边哈希，只过一遍数据）
+                downloaded_hash = hashlib.sha512()
+                r = SESSION.get(download_url, stream=True, timeout=60)
+                r.raise_for_status()
+                _stream_to_file(r, tgz_path, 'wb', downloaded_hash)
+
+            # 验证（直接比较原始摘要字节，无 base64 往返）
+            downloaded_hash_hex = downloaded_hash.hexdigest()
+
+            if downloaded_hash.digest() != bytes.fromhex(expected_sha512_hex):
+                os.remove(tgz_path)  # 删除坏文件
+                raise ValueError(f"SHA-512 校验失败! 预期: {expected_sha512_hex}, 得到: {downloaded_hash_hex}")
+
+            # 校验通过后写 sidecar，下次运行可跳过重新哈希
+            _write_sidecar(tgz_path, downloaded_hash_hex)
 
         # 准备元数据
-        # e.g., name: @angular/core -> group: @angular, name: core
-        group = ''
-        pkg_name = name
-        if '/' in name:
-            group, pkg_name = name.split('/', 1)
-
-        # Nexus 搜索时通常使用 "name-version" 格式, e.g., "react-18.2.0"
-        nexus_search_name = f"{pkg_name}-{version}"
-
-        meta_entry = {
-            'group': group,
-            'name': pkg_name,
-            'version': version,
-            'nexus_search_name': nexus_search_name,
-            'download_url': download_url,
-            'local_path': os.path.abspath(tgz_path),
-            'sha512_hex': downloaded_hash_hex  # 存储 hex 用于 Nexus API 比较
-        }
-        return meta_entry
+        return _build_meta_entry(name, version, download_url, tgz_path, downloaded_hash_hex)
 
     except Exception as e:
-        print(f"!! 下载 {name}@{version} 失败: {e}")
+        # 工作线程里用 logger 而不是 print：只入队，不抢 stdout 锁
+        logger.warning(f"!! 下载 {name}@{version} 失败: {e}")
         return None
 
 
 def main_download():
     """主下载函数"""
+    setup_queue_logging()
     try:
         config = load_config()
     except FileNotFoundError as e:
@@ -181,29 +325,71 @@ def main_download():
         print("没有找到要下载的包。")
         return
 
-    meta_info_list = []
-    max_workers = config.getint('Downloader', 'max_workers', fallback=10)
+    # 同一 (resolved, sha512) 因依赖提升/工作区结构常出现在多个
+    # node_modules 路径下；解析剥掉路径前缀后这些条目完全相同，
+    # 每个 tarball 只需下载、上传一次
+    seen = set()
+    unique_packages = []
+    for pkg in packages:
+        key = (pkg['resolved'], pkg['sha512_hex'])
+        if key not in seen:
+            seen.add(key)
+            unique_packages.append(pkg)
+    if len(unique_packages) != len(packages):
+        print(f"去重: {len(packages)} 个条目 -> {len(unique_packages)} 个唯一 tarball。")
+    packages = unique_packages
+
+    # 按主机名排序后再提交：同一主机的请求连续到达，连接池里的
+    # keep-alive 套接字得以连续复用，混合源 lockfile 下少开很多连接
+    packages.sort(key=lambda p: urlparse(p['resolved']).netloc)
+
+    # 配置相关的决策只求值一次，热路径里不再逐包读取配置；
+    # 目录提前转成绝对路径并创建，每个包少做一次 abspath 和 mkdir
+    downloader_cfg = config['Downloader']
+    download_dir = os.path.abspath(downloader_cfg.get('download_dir', 'npm_tgz'))
+    url_fn = _make_url_fn(downloader_cfg)
+    Path(download_dir).mkdir(exist_ok=True, parents=True)
+
+    meta_info_list = None
+
+    # 可选的 asyncio + aiohttp 路径：单线程即可维持大量在途请求
+    if config.getboolean('Downloader', 'use_async', fallback=False):
+        try:
+            from download_packages_async import download_all
+        except ImportError:
+            print("警告: use_async 已开启但未安装 aiohttp，退回线程池下载。")
+        else:
+            print("开始异步并行下载 (aiohttp)...")
+            meta_info_list = download_all(packages, config)
+
+    if meta_info_list is None:
+        meta_info_list = []
+        max_workers = config.getint('Downloader', 'max_workers', fallback=10)
 
-    print(f"开始并行下载，最大线程数: {max_workers}...")
+        print(f"开始并行下载，最大线程数: {max_workers}...")
 
-    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
-        # 提交任务
-        futures = [executor.submit(download_package, pkg, config) for pkg in packages]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            # 提交任务
+            futures = [executor.submit(download_package, pkg, url_fn, download_dir) for pkg in packages]
 
-        # 使用 tqdm 显示进度
-        for future in tqdm(concurrent.futures.as_completed(futures), total=len(futures), desc="下载进度"):
-            try:
-                result = future.result()
-                if result:
-                    meta_info_list.append(result)
-            except Exception as e:
-                # 这个异常理论上应该在 download_package 内部被捕获
-                print(f"!! 处理任务时发生意外错误: {e}")
+            # 使用 tqdm 显示进度
+            for future in tqdm(concurrent.futures.as_completed(futures), total=len(futures), desc="下载进度"):
+                try:
+                    result = future.result()
+                    if result:
+                        meta_info_list.append(result)
+                except Exception as e:
+                    # 这个异常理论上应该在 download_package 内部被捕获
+                    print(f"!! 处理任务时发生意外错误: {e}")
 
     meta_file = config.get('Downloader', 'meta_file', fallback='meta-info.json')
     try:
-        with open(meta_file, 'w', encoding='utf-8') as f:
-            json.dump(meta_info_list, f, indent=2, ensure_ascii=False)
+        if orjson is not None:
+            with open(meta_file, 'wb') as f:
+                f.write(orjson.dumps(meta_info_list, option=orjson.OPT_INDENT_2))
+        else:
+            with open(meta_file, 'w', encoding='utf-8') as f:
+                json.dump(meta_info_list, f, indent=2, ensure_ascii=False)
     except IOError as e:
         print(f"!! 写入元数据文件 {meta_file} 失败: {e}")
         return
@@ -211,7 +397,7 @@ def main_download():
     print("\n--- 下载完成 ---")
     print(f"成功下载 {len(meta_info_list)} / {len(packages)} 个包。")
     print(f"元数据已保存到: {meta_file}")
-    print(f"Tgz 文件已保存到: {config.get('Downloader', 'download_dir')}")
+    print(f"Tgz 文件已保存到: {download_dir}")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,91 @@
+"""基于 asyncio + aiohttp 的下载实现。
+
+单线程事件循环即可维持数百个在途请求，不受线程池 max_workers 的
+并发上限和线程切换开销限制，对高延迟源的大 lockfile 明显更快。
+aiohttp 是可选依赖：未安装时 main_download 会退回线程池路径。
+"""
+import asyncio
+import hashlib
+import logging
+import os
+
+import aiohttp
+from tqdm.asyncio import tqdm_asyncio
+from pathlib import Path
+
+from download_packages import (
+    READ_BUF,
+    _build_meta_entry,
+    _hash_cached_file,
+    _make_url_fn,
+    _read_sidecar,
+    _tgz_filename,
+    _write_sidecar,
+)
+
+logger = logging.getLogger(__name__)
+
+
+async def download_package_async(session, package_details, url_fn, download_dir):
+    """下载单个包，验证 checksum，并返回元数据（异步版）"""
+    name = package_details['name']
+    version = package_details['version']
+    expected_sha512_hex = package_details['sha512_hex']
+
+    download_url = url_fn(package_details)
+    tgz_path = os.path.join(download_dir, _tgz_filename(name, version))
+
+    try:
+        # 快速路径：sidecar 摘要与预期一致时直接返回
+        if _read_sidecar(tgz_path) == expected_sha512_hex:
+            return _build_meta_entry(name, version, download_url, tgz_path, expected_sha512_hex)
+
+        if os.path.exists(tgz_path):
+            # 整文件哈希放到线程里跑，避免阻塞事件循环
+            downloaded_hash = await asyncio.to_thread(_hash_cached_file, tgz_path)
+        else:
+            downloaded_hash = hashlib.sha512()
+            timeout = aiohttp.ClientTimeout(total=60)
+            async with session.get(download_url, timeout=timeout) as r:
+                r.raise_for_status()
+                with open(tgz_path, 'wb') as f:
+                    async for chunk in r.content.iter_chunked(READ_BUF):
+                        f.write(chunk)
+                        downloaded_hash.update(chunk)
+
+        # 验证
+        downloaded_hash_hex = downloaded_hash.hexdigest()
+        if downloaded_hash.digest() != bytes.fromhex(expected_sha512_hex):
+            os.remove(tgz_path)  # 删除坏文件
+            raise ValueError(f"SHA-512 校验失败! 预期: {expected_sha512_hex}, 得到: {downloaded_hash_hex}")
+
+        _write_sidecar(tgz_path, downloaded_hash_hex)
+        return _build_meta_entry(name, version, download_url, tgz_path, downloaded_hash_hex)
+
+    except Exception as e:
+        logger.warning(f"!! 下载 {name}@{version} 失败: {e}")
+        return None
+
+
+async def _download_all(packages, config):
+    downloader_cfg = config['Downloader']
+    download_dir = os.path.abspath(downloader_cfg.get('download_dir', 'npm_tgz'))
+    url_fn = _make_url_fn(downloader_cfg)
+    Path(download_dir).mkdir(exist_ok=True, parents=True)
+
+    limit = config.getint('Downloader', 'async_limit', fallback=50)
+    limit_per_host = config.getint('Downloader', 'async_limit_per_host', fallback=20)
+    connector = aiohttp.TCPConnector(limit=limit, limit_per_host=limit_per_host,
+                                     keepalive_timeout=30)
+
+    async with aiohttp.ClientSession(connector=connector) as session:
+        tasks = [download_package_async(session, pkg, url_fn, download_dir)
+                 for pkg in packages]
+        results = await tqdm_asyncio.gather(*tasks, desc="下载进度")
+
+    return [r for r in results if r]
+
+
+def download_all(packages, config):
+    """同步入口：异步下载整个批次并返回元数据列表"""
+    return asyncio.run(_download_all(packages, config))
@@ -0,0 +1,40 @@
+"""多线程场景下的队列化日志。
+
+工作线程通过 QueueHandler 只做入队（纳秒级、无 I/O），由单独的
+QueueListener 线程统一格式化并写出，避免高并发时各线程在 stdout
+锁上互相阻塞，也避免日志行和 tqdm 进度条互相穿插。
+"""
+import atexit
+import logging
+import queue
+from logging.handlers import QueueHandler, QueueListener
+
+_listener = None
+
+
+def setup_queue_logging(level=logging.INFO):
+    """初始化队列化日志；重复调用是无害的空操作"""
+    global _listener
+    if _listener is not None:
+        return _listener
+
+    q = queue.Queue(-1)
+    root = logging.getLogger()
+    root.setLevel(level)
+    root.addHandler(QueueHandler(q))
+
+    handler = logging.StreamHandler()
+    # 输出格式与原先的 print 保持一致
+    handler.setFormatter(logging.Formatter('%(message)s'))
+    _listener = QueueListener(q, handler)
+    _listener.start()
+    atexit.register(stop_queue_logging)
+    return _listener
+
+
+def stop_queue_logging():
+    """停止消费线程，冲刷剩余日志"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
@@ -1,215 +1,354 @@
-import json
-import os
-import requests
-import configparser
-from tqdm import tqdm
-
-
-class NexusUploader:
-    """封装Nexus API v1 操作"""
-
-    def __init__(self, config):
-        nexus_cfg = config['Nexus']
-        self.base_url = nexus_cfg.get('base_url').rstrip('/')
-        self.auth = (nexus_cfg.get('username'), nexus_cfg.get('password'))
-        self.upload_repo = nexus_cfg.get('upload_repository')
-
-        repos = nexus_cfg.get('check_repositories', self.upload_repo)
-        self.check_repos = [r.strip() for r in repos.split(',')]
-
-        self.session = requests.Session()
-        self.session.auth = self.auth
-        # 允许上传的API
-        self.upload_url = f"{self.base_url}/service/rest/v1/components?repository={self.upload_repo}"
-        # 搜索/删除组件的API
-        self.components_url = f"{self.base_url}/service/rest/v1/components"
-        self.search_components_url = f"{self.base_url}/service/rest/v1/search"
-
-        print(f"Nexus Uploader 初始化: URL={self.base_url}, UploadRepo={self.upload_repo}")
-        print(f"将检查以下仓库: {self.check_repos}")
-
-    def _find_component(self, repo, group, name, version):
-        """在指定仓库中查找组件"""
-        params = {
-            'repository': repo,
-            'name': name,
-            'version': version
-        }
-        if group:
-            params['group'] = group.replace('@', '')
-        else:
-            params['group'] = '""'
-
-        try:
-            r = self.session.get(self.search_components_url, params=params, timeout=30)
-            r.raise_for_status()
-            data = r.json()
-            if data.get('items'):
-                if len(data['items']) != 1:
-                    raise ValueError(f'返回结果不唯一,group:{group},name:{name}, version:{version}')
-                return data['items'][0]  # 返回第一个匹配项
-        except requests.HTTPError as e:
-            if e.response.status_code == 404:
-                return None
-            print(f"!! 查找组件时出错 ({repo}): {e}")
-        except Exception as e:
-            print(f"!! 查找组件时发生意外错误 ({repo}): {e}")
-        return None
-
-    def _get_remote_sha512_hex(self, component):
-        """从组件信息中提取 .tgz 资产的 sha512 (hex)"""
-        if not component or 'assets' not in component:
-            return None
-
-        for asset in component.get('assets', []):
-            # 确保我们拿到的是 .tgz 文件的 checksum
-            if asset.get('path', '').endswith('.tgz'):
-                checksums = asset.get('checksum', {})
-                # Nexus API 返回的是 hex 格式
-                return checksums.get('sha512')
-        return None
-
-    def _delete_component(self, component_id):
-        """按ID删除组件"""
-        delete_url = f"{self.components_url}/{component_id}"
-        try:
-            r = self.session.delete(delete_url, timeout=30)
-            r.raise_for_status()
-            print(f"    -> 成功删除旧组件 (ID: {component_id})")
-            return True
-        except Exception as e:
-            print(f"    -> !! 删除组件 {component_id} 失败: {e}")
-            return False
-
-    def _upload_package(self, package_meta):
-        """上传 .tgz 文件"""
-        local_path = package_meta['local_path']
-        if not os.path.exists(local_path):
-            print(f"    -> !! 文件 {local_path} 不存在，跳过上传。")
-            return False
-
-        # Nexus API v1 (npm) 需要 'npm.asset' 作为文件字段名
-        files = {
-            'npm.asset': (os.path.basename(local_path), open(local_path, 'rb'), 'application/x-gzip')
-        }
-
-        try:
-            r = self.session.post(self.upload_url, files=files, timeout=300)  # 上传可能需要更长时间
-            r.raise_for_status()
-            print(f"    -> 成功上传: {package_meta['name']}@{package_meta['version']}")
-            return True
-        except Exception as e:
-            print(f"    -> !! 上传 {package_meta['name']} 失败: {e}")
-            if hasattr(e, 'response') and e.response is not None:
-                print(f"    -> 响应: {e.response.text}")
-            return False
-
-    def process_package(self, package_meta):
-        """
-        处理单个包：检查、对比、删除、上传
-        """
-        group = package_meta['group']
-        name = package_meta['name']
-        version = package_meta['version']
-        local_sha512_hex = package_meta['sha512_hex']
-
-        pkg_id = f"{group}/{name}@{version}" if group else f"{name}@{version}"
-        print(f"--- 正在处理: {pkg_id} ---")
-
-        found_component = None
-        sha_matches = False
-
-        # 1. 检查所有 'check_repositories'
-        for repo in self.check_repos:
-            component = self._find_component(repo, group, name, version)
-            if component:
-                print(f"    -> 在仓库 '{repo}' 中找到。")
-                found_component = component
-                remote_sha512_hex = self._get_remote_sha512_hex(component)
-
-                if remote_sha512_hex == local_sha512_hex:
-                    print("    -> SHA-512 匹配。跳过。")
-                    sha_matches = True
-                else:
-                    print(
-                        f"    -> SHA-512 不匹配! (本地: {local_sha512_hex[:10]}... / 远程: {str(remote_sha512_hex)[:10]}...)")
-
-                break  # 只要在一个仓库找到就停止搜索
-
-        # 2. 如果已找到且 SHA 匹配，则跳过
-        if sha_matches:
-            return
-
-        # 3. 如果找到但不匹配 (SHA mismatch)
-        if found_component and not sha_matches:
-            # 只有当这个包位于 *我们即将上传的仓库* 时，我们才删除它
-            if found_component['repository'] == self.upload_repo:
-                print(f"    -> 在目标仓库 '{self.upload_repo}' 中发现不匹配的包，正在删除...")
-                self._delete_component(found_component['id'])
-            else:
-                print(
-                    f"    -> 在仓库 '{found_component['repository']}' 中发现不匹配的包，但目标仓库是 '{self.upload_repo}'。")
-                print("    -> 将继续上传到目标仓库 (可能导致重复，请检查Nexus配置)。")
-                # self._delete_component(found_component['id'])
-
-        # 4. 上传 (如果未找到，或已删除旧的)
-        print(f"    -> 准备上传到 '{self.upload_repo}'...")
-        self._upload_package(package_meta)
-
-
-def load_config():
-    """加载 config.ini 配置"""
-    config = configparser.ConfigParser()
-    if not os.path.exists('config.ini'):
-        raise FileNotFoundError("未找到 config.ini 配置文件。")
-    config.read('config.ini', 'utf-8')
-    return config
-
-
-def main_upload():
-    """主上传函数"""
-    try:
-        config = load_config()
-    except FileNotFoundError as e:
-        print(e)
-        return
-
-    meta_file = config.get('Downloader', 'meta_file', fallback='meta-info.json')
-
-    try:
-        with open(meta_file, 'r', encoding='utf-8') as f:
-            meta_info_list = json.load(f)
-    except FileNotFoundError:
-        print(f"错误: 元数据文件 {meta_file} 未找到。")
-        print("请先运行 '下载 npm 包' (选项 1)。")
-        return
-    except json.JSONDecodeError:
-        print(f"错误: 元数据文件 {meta_file} 格式损坏。")
-        return
-
-    if not meta_info_list:
-        print("元数据文件为空，没有需要上传的包。")
-        return
-
-    print(f"加载了 {len(meta_info_list)} 个包的元数据，开始上传到 Nexus...")
-
-    try:
-        uploader = NexusUploader(config)
-    except Exception as e:
-        print(f"初始化 Nexus Uploader 失败: {e}")
-        return
-
-    # 这里我们使用 for 循环而不是并行，因为上传/删除操作有依赖关系，
-    # 并且 Nexus 可能不喜欢高并发的 API 写入。
-    # 如果您有大量包，可以考虑改成 ThreadPoolExecutor，但要小心 API 速率限制。
-    for package_meta in tqdm(meta_info_list, desc="上传进度"):
-        try:
-            uploader.process_package(package_meta)
-        except Exception as e:
-            print(f"!! 处理 {package_meta.get('name', '未知包')} 时发生严重错误: {e}")
-
-    print("\n--- 上传过程完成 ---")
-
-
-if __name__ == "__main__":
+import json
+import logging
+import mmap
+import os
+import requests
+import configparser
+import concurrent.futures
+from requests.adapters import HTTPAdapter
+from tqdm import tqdm
+from urllib3.util.retry import Retry
+
+from log_setup import setup_queue_logging
+
+try:
+    # 可选依赖，meta 文件较大时加载明显更快
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    # 可选依赖：支持 HTTP/2 的客户端，见 NexusUploader._make_session
+    import httpx
+except ImportError:
+    httpx = None
+
+# raise_for_status 抛出的异常类型，requests 和 httpx 的都要能接住
+if httpx is not None:
+    _HTTP_STATUS_ERRORS = (requests.HTTPError, httpx.HTTPStatusError)
+else:
+    _HTTP_STATUS_ERRORS = (requests.HTTPError,)
+
+logger = logging.getLogger(__name__)
+
+
+class NexusUploader:
+    """封装Nexus API v1 操作"""
+
+    def __init__(self, config):
+        nexus_cfg = config['Nexus']
+        self.base_url = nexus_cfg.get('base_url').rstrip('/')
+        self.auth = (nexus_cfg.get('username'), nexus_cfg.get('password'))
+        self.upload_repo = nexus_cfg.get('upload_repository')
+
+        repos = nexus_cfg.get('check_repositories', self.upload_repo)
+        self.check_repos = [r.strip() for r in repos.split(',')]
+        self.upload_workers = config.getint('Nexus', 'upload_workers', fallback=4)
+
+        self.session = self._make_session()
+        # 允许上传的API
+        self.upload_url = f"{self.base_url}/service/rest/v1/components?repository={self.upload_repo}"
+        # 搜索/删除组件的API
+        self.components_url = f"{self.base_url}/service/rest/v1/components"
+        self.search_components_url = f"{self.base_url}/service/rest/v1/search"
+
+        print(f"Nexus Uploader 初始化: URL={self.base_url}, UploadRepo={self.upload_repo}")
+        print(f"将检查以下仓库: {self.check_repos}")
+
+        # 预先分页拉取各检查仓库的组件清单，把 "每包 x 每仓库" 的
+        # 搜索请求折叠成一次性的批量索引，之后的查找是 O(1) 字典访问
+        self._index = {}
+        for repo in self.check_repos:
+            index = self._index_repo(repo)
+            if index is not None:
+                self._index[repo] = index
+                print(f"已索引仓库 '{repo}': {len(index)} 个组件")
+
+    # 单仓库组件数超过该值时放弃建索引，退回逐包搜索（通常是大型代理仓库）
+    _MAX_INDEX_COMPONENTS = 20000
+
+    def _make_session(self):
+        """构造 API 客户端。
+
+        优先使用 httpx 的 HTTP/2 客户端：并发的查询/删除/上传可以在
+        同一条 TCP+TLS 连接上多路复用，整个上传阶段只握手一次。
+        未安装 httpx[http2]（http2=True 需要 'h2' 包）时退回
+        requests.Session + HTTP/1.1 keep-alive 连接池，接口完全兼容。
+        """
+        if httpx is not None:
+            try:
+                client = httpx.Client(
+                    http2=True,
+                    auth=self.auth,
+                    limits=httpx.Limits(max_keepalive_connections=20, max_connections=50),
+                )
+                print("Nexus API 使用 httpx HTTP/2 客户端。")
+                return client
+            except ImportError:
+                print("警告: httpx 缺少 http2 支持 (pip install 'httpx[http2]')，退回 requests。")
+
+        session = requests.Session()
+        session.auth = self.auth
+        # 挂载连接池适配器：让 keep-alive 在多个查询/上传之间复用连接，
+        # 池大小需 >= 上传线程数和检查的仓库数量，否则并发时会新建连接
+        pool_size = max(len(self.check_repos), self.upload_workers, 16)
+        adapter = HTTPAdapter(
+            pool_connections=pool_size,
+            pool_maxsize=pool_size,
+            max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[502, 503, 504]),
+        )
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        return session
+
+    def _index_repo(self, repo):
+        """分页拉取仓库全部组件，建立 (group, name, version) -> component 索引"""
+        index = {}
+        token = None
+        try:
+            while True:
+                params = {'repository': repo}
+                if token:
+                    params['continuationToken'] = token
+                r = self.session.get(self.components_url, params=params, timeout=60)
+                r.raise_for_status()
+                data = r.json()
+                for item in data.get('items', []):
+                    key = (item.get('group') or '', item.get('name'), item.get('version'))
+                    index[key] = item
+                if len(index) > self._MAX_INDEX_COMPONENTS:
+                    print(f"仓库 '{repo}' 组件过多 (>{self._MAX_INDEX_COMPONENTS})，退回逐包搜索。")
+                    return None
+                token = data.get('continuationToken')
+                if not token:
+                    return index
+        except Exception as e:
+            print(f"!! 为仓库 '{repo}' 建立索引失败，退回逐包搜索: {e}")
+            return None
+
+    def _find_component(self, repo, group, name, version):
+        """在指定仓库中查找组件（优先走预建索引，否则退回 search API）"""
+        if repo in self._index:
+            return self._index[repo].get((group.replace('@', ''), name, version))
+        return self._search_component(repo, group, name, version)
+
+    def _find_in_check_repos(self, group, name, version):
+        """在所有 check_repos 中查找组件，返回与 check_repos 顺序对应的结果列表。
+
+        需要走网络的仓库（无预建索引）并发查询，总耗时约等于最慢
+        一次 RTT 而不是各仓库 RTT 之和；结果仍按配置顺序排列，
+        调用方取第一个命中时优先级语义不变。
+        """
+        live_repos = [r for r in self.check_repos if r not in self._index]
+        if len(live_repos) > 1:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=len(live_repos)) as ex:
+                futures = {repo: ex.submit(self._search_component, repo, group, name, version)
+                           for repo in live_repos}
+            # with 块退出时所有查询均已完成
+            return [futures[r].result() if r in futures
+                    else self._find_component(r, group, name, version)
+                    for r in self.check_repos]
+        return [self._find_component(r, group, name, version) for r in self.check_repos]
+
+    def _search_component(self, repo, group, name, version):
+        """通过 search API 在指定仓库中查找组件（索引不可用时的回退路径）"""
+        params = {
+            'repository': repo,
+            'name': name,
+            'version': version
+        }
+        if group:
+            params['group'] = group.replace('@', '')
+        else:
+            params['group'] = '""'
+
+        try:
+            r = self.session.get(self.search_components_url, params=params, timeout=30)
+            r.raise_for_status()
+            data = r.json()
+            if data.get('items'):
+                if len(data['items']) != 1:
+                    raise ValueError(f'返回结果不唯一,group:{group},name:{name}, version:{version}')
+                return data['items'][0]  # 返回第一个匹配项
+        except _HTTP_STATUS_ERRORS as e:
+            if e.response.status_code == 404:
+                return None
+            logger.warning(f"!! 查找组件时出错 ({repo}): {e}")
+        except Exception as e:
+            logger.warning(f"!! 查找组件时发生意外错误 ({repo}): {e}")
+        return None
+
+    def _get_remote_sha512_hex(self, component):
+        """从组件信息中提取 .tgz 资产的 sha512 (hex)"""
+        if not component or 'assets' not in component:
+            return None
+
+        for asset in component.get('assets', []):
+            # 确保我们拿到的是 .tgz 文件的 checksum
+            if asset.get('path', '').endswith('.tgz'):
+                checksums = asset.get('checksum', {})
+                # Nexus API 返回的是 hex 格式
+                return checksums.get('sha512')
+        return None
+
+    def _delete_component(self, component_id):
+        """按ID删除组件"""
+        delete_url = f"{self.components_url}/{component_id}"
+        try:
+            r = self.session.delete(delete_url, timeout=30)
+            r.raise_for_status()
+            logger.info(f"    -> 成功删除旧组件 (ID: {component_id})")
+            return True
+        except Exception as e:
+            logger.warning(f"    -> !! 删除组件 {component_id} 失败: {e}")
+            return False
+
+    def _post_asset(self, local_path, fileobj):
+        """以 multipart 形式 POST 单个 .tgz 资产"""
+        # Nexus API v1 (npm) 需要 'npm.asset' 作为文件字段名
+        files = {
+            'npm.asset': (os.path.basename(local_path), fileobj, 'application/x-gzip')
+        }
+        return self.session.post(self.upload_url, files=files, timeout=300)  # 上传可能需要更长时间
+
+    def _upload_package(self, package_meta):
+        """上传 .tgz 文件"""
+        local_path = package_meta['local_path']
+        if not os.path.exists(local_path):
+            logger.warning(f"    -> !! 文件 {local_path} 不存在，跳过上传。")
+            return False
+
+        try:
+            # with 块保证文件句柄在上传后立即释放，并发时不会耗尽 FD
+            with open(local_path, 'rb') as fh:
+                try:
+                    # mmap 让请求体直接来自页缓存，省去 Python 层的读缓冲拷贝，
+                    # 并发上传大包时 RSS 不会随之膨胀。空文件无法 mmap，退回普通句柄。
+                    with mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                        r = self._post_asset(local_path, mm)
+                except (ValueError, OSError):
+                    r = self._post_asset(local_path, fh)
+            r.raise_for_status()
+            logger.info(f"    -> 成功上传: {package_meta['name']}@{package_meta['version']}")
+            return True
+        except Exception as e:
+            logger.warning(f"    -> !! 上传 {package_meta['name']} 失败: {e}")
+            if hasattr(e, 'response') and e.response is not None:
+                logger.warning(f"    -> 响应: {e.response.text}")
+            return False
+
+    def process_package(self, package_meta):
+        """
+        处理单个包：检查、对比、删除、上传
+        """
+        group = package_meta['group']
+        name = package_meta['name']
+        version = package_meta['version']
+        local_sha512_hex = package_meta['sha512_hex']
+
+        pkg_id = f"{group}/{name}@{version}" if group else f"{name}@{version}"
+        logger.info(f"--- 正在处理: {pkg_id} ---")
+
+        found_component = None
+        sha_matches = False
+
+        # 1. 检查所有 'check_repositories'（需要网络的仓库并发查询）
+        for repo, component in zip(self.check_repos,
+                                   self._find_in_check_repos(group, name, version)):
+            if component:
+                logger.info(f"    -> 在仓库 '{repo}' 中找到。")
+                found_component = component
+                remote_sha512_hex = self._get_remote_sha512_hex(component)
+
+                if remote_sha512_hex == local_sha512_hex:
+                    logger.info("    -> SHA-512 匹配。跳过。")
+                    sha_matches = True
+                else:
+                    logger.info(
+                        f"    -> SHA-512 不匹配! (本地: {local_sha512_hex[:10]}... / 远程: {str(remote_sha512_hex)[:10]}...)")
+
+                break  # 只要在一个仓库找到就停止搜索
+
+        # 2. 如果已找到且 SHA 匹配，则跳过
+        if sha_matches:
+            return
+
+        # 3. 如果找到但不匹配 (SHA mismatch)
+        if found_component and not sha_matches:
+            # 只有当这个包位于 *我们即将上传的仓库* 时，我们才删除它
+            if found_component['repository'] == self.upload_repo:
+                logger.info(f"    -> 在目标仓库 '{self.upload_repo}' 中发现不匹配的包，正在删除...")
+                self._delete_component(found_component['id'])
+            else:
+                logger.info(
+                    f"    -> 在仓库 '{found_component['repository']}' 中发现不匹配的包，但目标仓库是 '{self.upload_repo}'。")
+                logger.info("    -> 将继续上传到目标仓库 (可能导致重复，请检查Nexus配置)。")
+                # self._delete_component(found_component['id'])
+
+        # 4. 上传 (如果未找到，或已删除旧的)
+        logger.info(f"    -> 准备上传到 '{self.upload_repo}'...")
+        self._upload_package(package_meta)
+
+
+def load_config():
+    """加载 config.ini 配置"""
+    config = configparser.ConfigParser()
+    if not os.path.exists('config.ini'):
+        raise FileNotFoundError("未找到 config.ini 配置文件。")
+    config.read('config.ini', 'utf-8')
+    return config
+
+
+def main_upload():
+    """主上传函数"""
+    setup_queue_logging()
+    try:
+        config = load_config()
+    except FileNotFoundError as e:
+        print(e)
+        return
+
+    meta_file = config.get('Downloader', 'meta_file', fallback='meta-info.json')
+
+    try:
+        with open(meta_file, 'rb') as f:
+            raw = f.read()
+        meta_info_list = orjson.loads(raw) if orjson is not None else json.loads(raw)
+    except FileNotFoundError:
+        print(f"错误: 元数据文件 {meta_file} 未找到。")
+        print("请先运行 '下载 npm 包' (选项 1)。")
+        return
+    except ValueError:
+        print(f"错误: 元数据文件 {meta_file} 格式损坏。")
+        return
+
+    if not meta_info_list:
+        print("元数据文件为空，没有需要上传的包。")
+        return
+
+    print(f"加载了 {len(meta_info_list)} 个包的元数据，开始上传到 Nexus...")
+
+    try:
+        uploader = NexusUploader(config)
+    except Exception as e:
+        print(f"初始化 Nexus Uploader 失败: {e}")
+        return
+
+    def process_one(package_meta):
+        try:
+            uploader.process_package(package_meta)
+        except Exception as e:
+            logger.error(f"!! 处理 {package_meta.get('name', '未知包')} 时发生严重错误: {e}")
+
+    # 各包的 查找/删除/上传 相互独立，urllib3 连接池是线程安全的；
+    # 并发度由 [Nexus] upload_workers 控制（默认 4），避免压垮 Nexus 的写入 API
+    print(f"上传并发线程数: {uploader.upload_workers}")
+    with concurrent.futures.ThreadPoolExecutor(max_workers=uploader.upload_workers) as executor:
+        list(tqdm(executor.map(process_one, meta_info_list),
+                  total=len(meta_info_list), desc="上传进度"))
+
+    print("\n--- 上传过程完成 ---")
+
+
+if __name__ == "__main__":
     main_upload()
\ No newline at end of file